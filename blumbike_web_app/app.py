@@ -6,27 +6,50 @@
 
 # Import what we need
 import os
-import re
+import hmac
 import redis
 import dash
 import time
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 import datetime
 from natural import date
-import json
+import orjson
+import numpy as np
 import dash_bootstrap_components as dbc
 import dash_html_components as html
 import dash_core_components as dcc
 from dash.exceptions import PreventUpdate
 from plotly.subplots import make_subplots
-from dash.dependencies import Input, Output, ALL
-from flask import request
+from dash.dependencies import Input, Output, State, ALL
+from flask import request, Response, g
+from flask_caching import Cache
 import requests
 
 # These constants should match what is configured in the Photon firmware
 MIN_RESISTANCE = 1
 MAX_RESISTANCE = 10
 
+# How often (in ms) the browser polls for updates. The fast interval backs off to the idle rate when no session is in progress.
+FAST_INTERVAL_MS = 1000
+SLOW_INTERVAL_MS = 5000
+IDLE_INTERVAL_MS = 5000
+
+# The samples stream is capped at roughly this many entries (2 hours at one sample per second), so a session that never
+# receives its end_session event can't grow without bound
+MAX_SESSION_SAMPLES = 7200
+
+# How often (in ms) the browser checks whether a resistance command has finished
+RESISTANCE_POLL_MS = 250
+# How long (in seconds) the browser waits for a resistance command's result before giving up. This is longer than the particle
+# cloud request timeout, so the result is only missing if the background thread never got to store it.
+RESISTANCE_COMMAND_TIMEOUT = 10
+
+# Longer sessions are downsampled to this many points per graph trace before being sent to the browser
+MAX_GRAPH_POINTS = 300
+
 # Initialize the app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SOLAR], update_title=None)
 app.title = "blum.bike"
@@ -34,7 +57,68 @@ server = app.server  # This is the Flask Parent Server that we can use to receiv
 server.config['SECRET_KEY'] = os.environ.get("SECRET_KEY")
 
 # Connect to Redis for persistent storage of session data
-r = redis.from_url(os.environ.get("REDIS_URL"), decode_responses=True)
+# The connections are pooled and shared by all of the request threads. TCP keepalive and a periodic health check keep the
+# idle connections from being silently dropped (Heroku Redis closes idle clients), so a callback doesn't stall on a
+# reconnect. If every connection is busy, a thread waits briefly for one to free up rather than failing.
+redis_pool = redis.BlockingConnectionPool.from_url(os.environ.get("REDIS_URL"), max_connections=16, timeout=5, socket_keepalive=True,
+                                                   health_check_interval=30, decode_responses=True)
+r = redis.Redis(connection_pool=redis_pool)
+
+# The redis keys that hold the state of a session. These are cleared when a new session starts.
+SESSION_KEYS = ('samples', 'data_version', 'session_start', 'session_end', 'bike_ip')
+
+# This redis script appends a batch of samples to the samples stream, and runs entirely inside redis so the stale checks and
+# the writes happen atomically in a single round-trip. Each entry's stream ID is the sample's own timestamp (in ms, with the
+# sequence number counting up for samples in the same second), so the stream is ordered by sample time and the timestamp
+# doesn't need to be stored as a field. Samples older than the newest one in the stream, or that arrive after the session
+# has ended, are rejected. Otherwise each sample is added (the approximate MAXLEN lets redis trim whole nodes at a time,
+# which keeps the capped append O(1)) and the data version is bumped once so the callbacks know there is new data.
+# KEYS: samples, session_end, data_version
+# ARGV: max stream length, then sample time in ms, bike_mph, resistance, heart_bpm for each sample (oldest first)
+# Returns the number of samples that were appended.
+APPEND_SAMPLE_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+local newest_ms, newest_seq = -1, -1
+local newest = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', 1)[1]
+if newest then
+    local ms, seq = string.match(newest[1], '^(%d+)-(%d+)$')
+    newest_ms, newest_seq = tonumber(ms), tonumber(seq)
+end
+local appended = 0
+for i = 2, #ARGV, 4 do
+    local ms = tonumber(ARGV[i])
+    if ms >= newest_ms then
+        local seq = 0
+        if ms == newest_ms then
+            seq = newest_seq + 1
+        end
+        redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], ARGV[i] .. '-' .. seq, 'bike_mph', ARGV[i + 1], 'resistance', ARGV[i + 2], 'heart_bpm', ARGV[i + 3])
+        newest_ms, newest_seq = ms, seq
+        appended = appended + 1
+    end
+end
+if appended > 0 then
+    redis.call('INCR', KEYS[3])
+end
+return appended
+"""
+append_sample = r.register_script(APPEND_SAMPLE_SCRIPT)
+
+# This lua script clears the previous session and records the new one's start time and bike IP in one atomic step, so a
+# sample arriving mid-way can never land in a half-reset session.
+# KEYS: session_start, bike_ip, then every key to clear (SESSION_KEYS), ARGV: session start time, bike IP
+START_SESSION_SCRIPT = """
+redis.call('UNLINK', unpack(KEYS, 3))
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], ARGV[2])
+return 1
+"""
+start_session = r.register_script(START_SESSION_SCRIPT)
+
+# Results computed from a whole session are also cached in redis, so only one gunicorn worker has to build each of them
+cache = Cache(server, config={'CACHE_TYPE': 'redis', 'CACHE_REDIS_URL': os.environ.get("REDIS_URL"), 'CACHE_DEFAULT_TIMEOUT': 300})
 
 # Define the dashboard layout
 sidebar =   dbc.Col(children=[
@@ -45,6 +129,8 @@ sidebar =   dbc.Col(children=[
                                 dbc.Button('Increase Resistance', id={"index": "up", "type": "resistance"}, color="info", style={"width": "40%", "margin": "0px 5%"}, n_clicks=0, disabled=False, className="shadow-none"),
                             ], className="card-body bs-component", style={"display": "flex", "width": "100%"}),
                             dbc.Alert("Command Status Alert", id="resistance-status", is_open=False, duration=3000, style={"width": "80%", "textAlign": "center", "margin": "0px 10% 10px"}),
+                            dcc.Store(id='resistance-command'),
+                            dcc.Interval(id='resistance-poll', interval=RESISTANCE_POLL_MS, disabled=True),
                             html.Div(id='control-panel-footer', children=[], className="card-footer text-muted")
                         ], className='card mb-3'),
                         html.Div(id='stats-sidebar', children=[
@@ -66,10 +152,12 @@ content =   dbc.Col(className='col-12 col-sm-12 col-md-12 col-lg-7 col-lg-offset
                                  ),
                         html.Div(id='live-graph-div', style={'visibility': 'hidden'}, # Starts Hidden so the Graph can load first
                                  children=[
-                                    dcc.Graph(id='live-update-graph', config={'displayModeBar': False})
+                                    dcc.Graph(id='live-update-graph', config={'displayModeBar': False}),
+                                    dcc.Store(id='graph-cursor')
                                  ]),
-                        dcc.Interval(id='interval-component-fast', interval=1000, n_intervals=0),
-                        dcc.Interval(id='interval-component-slow', interval=5000, n_intervals=0)
+                        dcc.Interval(id='interval-component-fast', interval=FAST_INTERVAL_MS, n_intervals=0),
+                        dcc.Interval(id='interval-component-slow', interval=SLOW_INTERVAL_MS, n_intervals=0),
+                        dcc.Store(id='auth-state')
                     ])
 
 main = dbc.Row(children=[sidebar, content], id='main-content')
@@ -104,79 +192,137 @@ footer = html.Footer(
 app.layout = dbc.Container([main, footer], style={'padding': '15px'}, fluid=True)
 
 
+# The api key that the Particle webhook must send, read once at startup. None if it isn't configured, in which case every request is refused.
+API_KEY = os.environ.get("apikey", "").encode() or None
+
+
+# This helper function builds the JSON reply sent back to the Particle webhook, serialized with orjson rather than Flask's jsonify
+def json_reply(reply, status=200):
+    return Response(orjson.dumps({"reply": reply}), status=status, mimetype='application/json')
+
+
 # A decorator function to require an api key for pushing data to this application from the Particle webhook
 # https://coderwall.com/p/4qickw/require-an-api-key-for-a-route-in-flask-using-only-a-decorator
 def require_apikey(view_function):
     @wraps(view_function)
     # the new, post-decoration function. Note *args and **kwargs here.
     def decorated_function(*args, **kwargs):
-        if request.json['apikey'] and "apikey" in os.environ and request.json['apikey'] == str(os.environ.get("apikey")):
+        # A missing or malformed body is refused the same way as a wrong key, rather than raising an exception (and a 500)
+        body = request.get_json(silent=True)
+        supplied_key = body.get('apikey') if isinstance(body, dict) else None
+        # compare_digest takes the same time wherever the keys differ, so the key can't be guessed from response timing
+        if API_KEY and supplied_key and hmac.compare_digest(str(supplied_key).encode(), API_KEY):
+            # The view reads the body that was already parsed here from g, rather than fetching it from the request again
+            g.body = body
             return view_function(*args, **kwargs)
         else:
-            print("invalid api key match")
-            return {"reply": "invalid key"}, 401
+            return json_reply("invalid key", 401)
     return decorated_function
 
 
+# The fields each session event must carry (new_data samples are checked as they are appended)
+EVENT_FIELDS = {
+    'powered_on': ('t',),
+    'start_session': ('t', 'ip'),
+    'end_session': ('t',),
+}
+
+
 # Receive incoming data as POST JSON objects from the Particle Cloud
 @server.route('/update', methods=['POST'])
 @require_apikey
 def rest_update():
-    latest_data = json.loads(request.json['data'])
+    # The webhook normally delivers the event data as a JSON string inside the JSON body. If it is configured to embed the
+    # data as an object instead (see the README), it was already parsed along with the body and is used as-is.
+    latest_data = g.body.get('data')
+    if latest_data is None:
+        return json_reply("no data", 400)
+    if isinstance(latest_data, str):
+        try:
+            latest_data = orjson.loads(latest_data)
+        except orjson.JSONDecodeError:
+            return json_reply("malformed data", 400)
+    # The photon may also buffer a few readings and publish them together as a JSON array of new_data samples (see the README)
+    if isinstance(latest_data, list):
+        latest_data = {'event': 'new_data', 'samples': latest_data}
+    # Anything other than an event object is refused here, rather than raising (and a 500) further down
+    if not isinstance(latest_data, dict) or 'event' not in latest_data:
+        return json_reply("malformed data", 400)
+    if latest_data['event'] in EVENT_FIELDS:
+        if any(field not in latest_data for field in EVENT_FIELDS[latest_data['event']]):
+            return json_reply("malformed data", 400)
+        # The event times are read back as whole seconds, so anything else is refused too
+        try:
+            latest_data['t'] = int(latest_data['t'])
+        except (ValueError, TypeError):
+            return json_reply("malformed data", 400)
 
     # The "event" key will be:
     # "powered_on" when the Photon is turned on
     # "start_session" when the Photon has detected that a new session has started
     # "end_session" when the Photon has detected that a session has ended
-    # "new_data" for new bike stats
+    # "new_data" for new bike stats (one sample, or a batch of them under "samples")
     if latest_data['event'] == "powered_on":
         # This triggers when the photon is powered on
         # Note when this session started
         r.set("powered_on", latest_data['t'])
         print("BIKE POWERED ON: {}".format(latest_data))
-        return {"reply": "power on received"}
+        return json_reply("power on received")
 
     if latest_data['event'] == "start_session":
-        # When user has initiated a new session (sequential non-zero dyno RPMs), we clear all existing redis data
-        r.flushdb()
-        # Note when this session started
-        r.set("session_start", latest_data['t'])
+        # When user has initiated a new session (sequential non-zero dyno RPMs), we clear the previous session's data and note
+        # when this session started. Only this app's session keys are removed (the shared results cache and anything else in
+        # the db are left alone), and UNLINK frees the old samples stream in the background rather than blocking redis.
         # The particle's public IP will also be sent at session start. We save this and show resistance control to clients originating from the same IP
-        r.set("bike_ip", latest_data['ip'])
+        # This is all done atomically in a single round-trip, see START_SESSION_SCRIPT.
+        start_session(keys=['session_start', 'bike_ip'] + list(SESSION_KEYS), args=[latest_data['t'], latest_data['ip']])
+        set_cached_bike_ip(latest_data['ip'])
+        clear_cached_session_state()
         print("STARTED A NEW SESSION: {}".format(latest_data))
-        return {"reply": "started session"}
+        return json_reply("started session")
 
     if latest_data['event'] == "end_session":
         # When user has finished a new session (sequential non-zero dyno RPMs), we can note that in the UI
-        r.set("session_end", latest_data['t'])
-        r.delete("bike_ip")
-        time.sleep(.1)  # Briefly sleep after the end of a session to ensure the session end is set in redis
+        # The end time is set and the bike IP removed together in one MULTI/EXEC round-trip
+        pipe = r.pipeline()
+        pipe.set("session_end", latest_data['t'])
+        pipe.delete("bike_ip")
+        pipe.execute()
+        set_cached_bike_ip(None)
+        clear_cached_session_state()
         print("ENDED THE SESSION: {}".format(latest_data))
-        return {"reply": "ended session"}
+        return json_reply("ended session")
 
     elif latest_data['event'] == "new_data":
-        # If a value comes in out of order, discard it.
-        if (r.exists('timestamp') and int(r.lindex('timestamp', 0)) > int(latest_data['t'])) or r.exists('session_end'):
+        # Append the samples to the session's redis stream, oldest first. Any that came in out of order (or after the session
+        # ended) are discarded. The whole batch is a single atomic round-trip, see APPEND_SAMPLE_SCRIPT.
+        # A batch is refused as a whole if anything in it isn't a complete new_data sample
+        samples = latest_data.get('samples', [latest_data])
+        if not isinstance(samples, list) or not samples or \
+                not all(isinstance(sample, dict) and sample.get('event') == "new_data" for sample in samples):
+            return json_reply("malformed data", 400)
+        try:
+            samples = sorted(samples, key=lambda sample: int(sample['t']))
+            args = [MAX_SESSION_SAMPLES]
+            for sample in samples:
+                # The readings are converted here so that only numbers are ever stored, since every callback parses them back as such
+                args += [int(sample['t']) * 1000, float(sample['bike_mph']), int(sample['resistance']), float(sample['heart_bpm'])]
+        except (KeyError, ValueError, TypeError):
+            return json_reply("malformed data", 400)
+        appended = append_sample(keys=['samples', 'session_end', 'data_version'], args=args)
+        if not appended:
             print("IGNORED (STALE): {}".format(latest_data))
-            return {"reply": "ignored stale data"}
-
-        # Push the data into a running list in redis
-        r.lpush('timestamp', latest_data['t'])
-        r.lpush('bike_mph', latest_data['bike_mph'])
-        r.lpush('resistance', latest_data['resistance'])
-        r.lpush('heart_bpm', latest_data['heart_bpm'])
-
-        # Keep the list trimmed (disabled. Shouldn't be necessary to trim the list since we end sessions when the bike stops).
-        # r.ltrim('timestamp', 0, 300)
-        # r.ltrim('bike_mph', 0, 300)
-        # r.ltrim('heart_bpm', 0, 300)
+            return json_reply("ignored stale data")
+        if appended < len(samples):
+            print("IGNORED {} STALE SAMPLE(S)".format(len(samples) - appended))
 
+        clear_cached_session_state()
         print("APPENDED: {}".format(latest_data))
-        return {"reply": "data appended"}
+        return json_reply("data appended")
 
     else:
         print("APPENDED: {}".format(latest_data))
-        return {"reply": "event '{}' not understood".format(latest_data['event'])}, 501
+        return json_reply("event '{}' not understood".format(latest_data['event']), 501)
 
 
 # This callback generates the control sidebar by checking if user is authorized and unhiding the control buttons.
@@ -186,9 +332,12 @@ def rest_update():
 # The div can also just easily be unhidden using the browser inspection tools, but we refuse to send the actual control command unless the IPs match,
 # and a potential attacker should have no way of knowing what IP they need to spoof.
 # We also show the control sidebar panel when running in local dev mode.
-@app.callback([Output('control-panel-footer', 'children'), Output('control-sidebar', 'hidden')],
-              [Input('interval-component-fast', 'n_intervals')])
-def update_control_sidebar(n):
+# The authorization only changes when a session starts or ends, so it is checked on the slow interval and stored in the browser.
+# The store is only written when the result changes, and the sidebar itself is updated from it by the clientside callback below.
+@app.callback(Output('auth-state', 'data'),
+              [Input('interval-component-slow', 'n_intervals')],
+              [State('auth-state', 'data')])
+def update_auth_state(n, current_auth_reason):
     auth_reason = False
 
     if ip_matches():
@@ -196,14 +345,64 @@ def update_control_sidebar(n):
     elif "mode" in os.environ and str(os.environ.get("mode")) == "dev":
         auth_reason = "Dev Mode"
 
-    if auth_reason:
-        return ["Control Authorized (" + auth_reason + ")"], False
+    if auth_reason == current_auth_reason:
+        raise PreventUpdate
 
-    return [], True
+    return auth_reason
 
 
-# This helper function returns true if the client IP matches the IP of the photon that is stored in Redis
-def ip_matches():
+# This callback runs in the browser to show or hide the control sidebar whenever the stored authorization changes
+app.clientside_callback(
+    """
+    function(auth_reason) {
+        if (auth_reason) {
+            return [["Control Authorized (" + auth_reason + ")"], false];
+        }
+        return [[], true];
+    }
+    """,
+    [Output('control-panel-footer', 'children'), Output('control-sidebar', 'hidden')],
+    [Input('auth-state', 'data')]
+)
+
+
+# This callback adjusts how often each browser polls. Nothing changes between sessions, so while the bike is idle
+# the fast interval is slowed down to the idle rate, and sped back up once a new session has started.
+@app.callback(Output('interval-component-fast', 'interval'),
+              [Input('interval-component-slow', 'n_intervals')])
+def update_poll_rate(n):
+    state = session_state()
+    if state['session_start'] is not None and state['session_end'] is None:
+        return FAST_INTERVAL_MS
+    return IDLE_INTERVAL_MS
+
+
+# The photon IP only changes when a session starts or ends, so each worker caches it for a few seconds rather than reading it from
+# redis on every authorization check. The entry is a single (ip, expiry time) tuple so that it is always swapped in whole.
+BIKE_IP_CACHE_SECONDS = 5
+bike_ip_entry = (None, 0.0)
+
+
+# This helper function replaces the cached photon IP. The webhook handlers call it when they change the IP in redis, so the worker
+# that handled the session change doesn't wait for its cache to expire.
+def set_cached_bike_ip(ip):
+    global bike_ip_entry
+    bike_ip_entry = (ip, time.monotonic() + BIKE_IP_CACHE_SECONDS)
+
+
+# This helper function returns the photon IP that is stored in Redis (or None), refreshing the cached copy once it has expired
+def bike_ip():
+    ip, expires = bike_ip_entry
+    if time.monotonic() >= expires:
+        ip = r.get('bike_ip')
+        set_cached_bike_ip(ip)
+    return ip
+
+
+# This helper function returns true if the client IP matches the IP of the photon that is stored in Redis.
+# The authorization check uses this worker's cached photon IP, but the check before sending a command passes cached=False to
+# read the IP from redis, so an ended (or previous) session's IP can never be used to control the bike.
+def ip_matches(cached=True):
     # See here about getting the client IP that connects to Heroku: https://stackoverflow.com/a/37061471
     client_ip = request.remote_addr  # For local development
     if 'X-Forwarded-For' in request.headers:
@@ -211,52 +410,119 @@ def ip_matches():
         ip_list = proxy_data.split(',')
         client_ip = ip_list[0]  # first address in list is User IP
 
-    if r.exists('bike_ip') and client_ip == r.get('bike_ip'):
+    # There is no bike IP (None) between sessions, which never matches
+    if client_ip == (bike_ip() if cached else r.get('bike_ip')):
         return True
 
     return False
 
 
-# This callback triggers when a resistance control button is clicked
-@app.callback([Output({'type': 'resistance', 'index': 'down'}, 'disabled'),
-               Output({'type': 'resistance', 'index': 'up'}, 'disabled'),
-               Output('resistance-status', 'children'),
-               Output('resistance-status', 'is_open'),
-               Output('resistance-status', 'color')],
+# Resistance commands are sent to the photon from these background threads, so the button callback doesn't sit waiting on the
+# particle cloud. The result of each command is stored in redis (so whichever worker the browser polls can find it) for a minute.
+particle_executor = ThreadPoolExecutor(max_workers=2)
+PARTICLE_RESULT_KEY = 'particle_command:{}'
+
+
+# This helper function runs in a background thread to send a command to the photon and store its result in redis
+def run_particle_command(command_id, cmd):
+    try:
+        result = particle_cloud_function(cmd)
+    except Exception as e:
+        print('Command Failed - {}'.format(e))
+        result = (False, "An unknown failure occurred.", {})
+    try:
+        r.set(PARTICLE_RESULT_KEY.format(command_id), orjson.dumps(result), ex=60)
+    except redis.RedisError as e:
+        # The browser stops waiting for the result once RESISTANCE_COMMAND_TIMEOUT has passed
+        print('Failed to store command result - {}'.format(e))
+
+
+# This callback triggers when a resistance control button is clicked.
+# It hands the command off to a background thread and returns straight away. The update_resistance_status() callback below then
+# polls for the result and shows it. A second click while a command is still running simply supersedes the first one's status.
+@app.callback(Output('resistance-command', 'data'),
               [Input({'type': 'resistance', 'index': ALL}, 'n_clicks')])
 def change_resistance(n_clicks):
-    changed_id = [p['prop_id'] for p in dash.callback_context.triggered][0]
+    # The triggering prop_id looks like '{"index":"up","type":"resistance"}.n_clicks', so the button id is everything before the last dot
     try:
-        index =  json.loads(re.search(r'(\{.*?\})', changed_id).group(1))['index']
-    except AttributeError as e:
+        changed_id = dash.callback_context.triggered[0]['prop_id']
+        index = orjson.loads(changed_id.rsplit('.', 1)[0])['index']
+    except (KeyError, ValueError, IndexError, TypeError):
         raise PreventUpdate
 
     if index == 'down' or index == 'up':
-        # As described in the update_control_sidebar() comments, we check the IP again and only send the command if there is a match.
+        # As described in the update_auth_state() comments, we check the IP again and only send the command if there is a match.
         prefix = ""
-        if not ip_matches():
+        if not ip_matches(cached=False):
             if "mode" in os.environ and str(os.environ.get("mode")) == "dev":
                 prefix = "[Dev Override] "
             else:
-                return False, False, "Command blocked due to IP mismatch.", True, 'warning'
-
-        success, msg, data = particle_cloud_function('resistance_' + index)
-        if success:
-            res = int(data["return_value"])
-            alert_text = prefix + "Resistance set to " + str(res)
-            if res == MIN_RESISTANCE:
-                return True, False, alert_text + " (Min)", True, 'success'
-            elif res == MAX_RESISTANCE:
-                return False, True, alert_text + " (Max)", True, 'success'
-            else:
-                return False, False, alert_text, True, 'success'
-        else:
-            alert_text = prefix + msg
-            return False, False, alert_text, True, "primary"
+                return {'blocked': True}
+
+        command_id = uuid.uuid4().hex
+        particle_executor.submit(run_particle_command, command_id, 'resistance_' + index)
+        return {'id': command_id, 'prefix': prefix, 'issued': time.time()}
 
     raise PreventUpdate
 
 
+# This callback shows the result of the latest resistance command. It polls until the background thread has stored the result,
+# or until RESISTANCE_COMMAND_TIMEOUT has passed without one (if the thread failed to store it or its worker restarted).
+@app.callback([Output({'type': 'resistance', 'index': 'down'}, 'disabled'),
+               Output({'type': 'resistance', 'index': 'up'}, 'disabled'),
+               Output('resistance-status', 'children'),
+               Output('resistance-status', 'is_open'),
+               Output('resistance-status', 'color'),
+               Output('resistance-poll', 'disabled')],
+              [Input('resistance-command', 'data'), Input('resistance-poll', 'n_intervals')])
+def update_resistance_status(command, n):
+    if not command:
+        raise PreventUpdate
+
+    if command.get('blocked'):
+        return False, False, "Command blocked due to IP mismatch.", True, 'warning', True
+
+    result = r.get(PARTICLE_RESULT_KEY.format(command['id']))
+    if result is None:
+        if time.time() - command['issued'] > RESISTANCE_COMMAND_TIMEOUT:
+            return False, False, command['prefix'] + "Command timed out!", True, "primary", True
+        # Still waiting on the photon, so keep polling
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update, False
+
+    success, msg, data = orjson.loads(result)
+    prefix = command['prefix']
+    if success:
+        res = int(data["return_value"])
+        alert_text = prefix + "Resistance set to " + str(res)
+        if res == MIN_RESISTANCE:
+            return True, False, alert_text + " (Min)", True, 'success', True
+        elif res == MAX_RESISTANCE:
+            return False, True, alert_text + " (Max)", True, 'success', True
+        else:
+            return False, False, alert_text, True, 'success', True
+    else:
+        alert_text = prefix + msg
+        return False, False, alert_text, True, "primary", True
+
+
+# Requests to the particle cloud share one session, so the TLS connection to the API is kept alive and reused between commands
+# instead of being set up again for every button click
+particle_session = requests.Session()
+particle_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+# The status message shown in the UI, and the explanation that is logged, for each reply code from the particle cloud
+PARTICLE_STATUS = {
+    200: ("Command sent successfully.", 'OK - Your Request was successfully delivered to the device and executed.'),
+    400: ("Command Failed! Is the bike on?", 'Bad Request - Your request is not understood by the device, or the requested subresource has not been exposed.'),
+    401: ("Control not Authorized!", 'Unauthorized - Your access token is not valid.'),
+    403: ("Control not Authorized for this Device!", 'Forbidden - Your access token is not authorized to interface with this device.'),
+    404: ("Device not available!", 'Not Found - The device you requested is not currently connected to the Particle cloud.'),
+    408: ("Command timed out!", 'Timed Out - The Particle cloud experienced a significant delay when trying to reach the device.'),
+    429: ("Command speed limit exceeded!", 'Too Many Requests - You are either making requests too often or too many at the same time.'),
+    500: ("Server error encountered!", 'Server error. Something is wrong with the Particle Cloud.'),
+}
+
+
 # This helper function sends a request to the particle cloud using the auth token and photon ID that should be stored in env vars.
 # The command input is the name of the photon function to execute
 # Returns a tuple with a boolean indicating success/failure, a status message, and the reply contents
@@ -264,259 +530,363 @@ def particle_cloud_function(cmd):
     address = 'https://api.particle.io/v1/devices/{}/{}'.format(os.environ.get("PARTICLE_ID"), cmd)
     data = {'access_token': os.environ.get("PARTICLE_TOKEN"), 'arg': ''}
 
-    success = False
-    msg = "An unknown failure occurred."
+    try:
+        req = particle_session.post(address, data=data, timeout=5)
+    except requests.exceptions.RequestException as e:
+        print('Request Failed - Could not reach the Particle cloud: {}'.format(e))
+        return False, "Command timed out!", {}
 
-    req = requests.post(address, data=data)
     returned_data = req.json()
-    if req.status_code == 200:
-        success = True
-        msg = "Command sent successfully."
-        print('OK - Your Request was successfully delivered to the device and executed.')
-    elif req.status_code == 400:
-        success = False
-        msg = "Command Failed! Is the bike on?"
-        print('Bad Request - Your request is not understood by the device, or the requested subresource has not been exposed.')
-    elif req.status_code == 401:
-        success = False
-        msg = "Control not Authorized!"
-        print('Unauthorized - Your access token is not valid.')
-    elif req.status_code == 403:
-        success = False
-        msg = "Control not Authorized for this Device!"
-        print('Forbidden - Your access token is not authorized to interface with this device.')
-    elif req.status_code == 404:
-        success = False
-        msg = "Device not available!"
-        print('Not Found - The device you requested is not currently connected to the Particle cloud.')
-    elif req.status_code == 408:
-        success = False
-        msg = "Command timed out!"
-        print('Timed Out - The Particle cloud experienced a significant delay when trying to reach the device.')
-    elif req.status_code == 429:
-        success = False
-        msg = "Command speed limit exceeded!"
-        print('Too Many Requests - You are either making requests too often or too many at the same time.')
-    elif req.status_code == 500:
-        success = False
-        msg = "Server error encountered!"
-        print('Server error. Something is wrong with the Particle Cloud.')
-
-    return success, msg, returned_data
+    msg, explanation = PARTICLE_STATUS.get(req.status_code, ("An unknown failure occurred.", None))
+    if explanation:
+        print(explanation)
+
+    return req.status_code == 200, msg, returned_data
+
+
+# This helper function returns the time (in seconds) of a sample from its stream ID
+def sample_time(entry_id):
+    return int(entry_id.split('-', 1)[0]) // 1000
+
+
+# This helper function reads every sample of the current session from the redis stream in a single round-trip.
+# Returns a dict mapping 't' to a list of the sample times, and each field name to a list of its (string) values, oldest first.
+# 'last_id' is the stream ID of the newest sample read, or None if there are none.
+def session_samples(start='-'):
+    entries = r.xrange('samples', min=start)
+    samples = {field: [fields[field] for _, fields in entries] for field in ('bike_mph', 'resistance', 'heart_bpm')}
+    samples['t'] = [sample_time(entry_id) for entry_id, _ in entries]
+    samples['last_id'] = entries[-1][0] if entries else None
+    return samples
+
+
+# Every open dashboard polls the session state (its start and end, the data version and the newest sample) at least once a
+# second. Each worker reads that state from redis at most once per SESSION_STATE_CACHE_SECONDS and shares the snapshot between
+# all of its clients, so the redis load follows the number of workers rather than the number of open tabs. As with the photon
+# IP, the entry is a single (state, expiry time) tuple so that it is always swapped in whole.
+SESSION_STATE_CACHE_SECONDS = 1
+session_state_entry = (None, 0.0)
+
+
+# This helper function returns the current session state as a dict, reading it from redis in a single round-trip once the
+# cached snapshot has expired. 'newest' is the (stream ID, fields) of the latest sample, or None if there's no data yet.
+def session_state():
+    global session_state_entry
+    state, expires = session_state_entry
+    now = time.monotonic()
+    if now >= expires:
+        pipe = r.pipeline(transaction=False)
+        pipe.mget('session_start', 'session_end', 'data_version')
+        pipe.xrevrange('samples', count=1)
+        (session_start, session_end, data_version), newest = pipe.execute()
+        state = {'session_start': session_start, 'session_end': session_end, 'data_version': data_version,
+                 'newest': newest[0] if newest else None}
+        session_state_entry = (state, now + SESSION_STATE_CACHE_SECONDS)
+    return state
+
+
+# This helper function drops the cached session state. The webhook handlers call it after changing the session, so clients of
+# the worker that handled it see the change straight away.
+def clear_cached_session_state():
+    global session_state_entry
+    session_state_entry = (None, 0.0)
+
+
+# Results computed from the whole session (the graph figure and the summary stats) are cached in-process under the
+# (session start, data version) key they were built from. The data version is bumped each time a sample is appended,
+# so an unchanged key means the cached result is still current and redis doesn't need to be read again.
+# The build functions are also memoized on that key in the shared redis cache, so a worker whose in-process entry is out
+# of date can usually pick up the result another worker already built.
+session_cache = {'graph': (None, None), 'stats': (None, None)}
+session_cache_lock = threading.Lock()
+
+
+# This helper function returns the cached result for name if it was built from key, otherwise calls build(key) to refresh it.
+# The lock makes concurrent callbacks wait for a single rebuild instead of all reading the whole session at once.
+def cached(name, key, build):
+    entry = session_cache[name]
+    if entry[0] != key:
+        with session_cache_lock:
+            entry = session_cache[name]
+            if entry[0] != key:
+                entry = (key, build(key))
+                session_cache[name] = entry
+    return entry[1]
+
+
+# This helper function computes the average and max of each reading over the whole session.
+# The key is only used by the memoization, so that each new data version is computed once.
+# Returns a dict of the stats, or None if there are no readings.
+@cache.memoize()
+def session_stats(key):
+    samples = session_samples()
+    if len(samples['t']) == 0:
+        return None
+    # The reductions run over NumPy arrays rather than Python lists
+    speed_readings = np.array(samples['bike_mph'], dtype=np.float64)
+    resistance_readings = np.array(samples['resistance'], dtype=np.int64)
+    heart_readings = np.array(samples['heart_bpm'], dtype=np.float64)
+    return {
+        'speed_avg': float(speed_readings.mean()),
+        'speed_max': float(speed_readings.max()),
+        'resistance_avg': float(resistance_readings.mean()),
+        'resistance_max': int(resistance_readings.max()),
+        'heartrate_avg': float(heart_readings.mean()),
+        'heartrate_max': float(heart_readings.max())
+    }
 
 
 # This callback triggers on an interval to update the text into the sidebar using the latest data in redis
 @app.callback([Output('live-update-body', 'children'), Output('live-update-footer', 'children')],
               [Input('interval-component-fast', 'n_intervals')])
 def update_metrics(n):
-
-    if r.exists('session_end') and r.exists('timestamp'):
-        start_datetime = datetime.datetime.fromtimestamp(int(r.get('session_start')))
-        end_datetime = datetime.datetime.fromtimestamp(int(r.get('session_end')))
-        speed_readings = [float(i) for i in r.lrange('bike_mph', 0, -1)]
-        resistance_readings = [int(i) for i in r.lrange('resistance', 0, -1)]
-        heart_readings = [float(i) for i in r.lrange('heart_bpm', 0, -1)]
-        if len(speed_readings) > 0 and len(heart_readings) > 0:
+    # Everything the sidebar needs comes from the shared session state snapshot. The newest stream entry holds every field of
+    # the latest reading.
+    state = session_state()
+    session_start, session_end, data_version, newest = state['session_start'], state['session_end'], state['data_version'], state['newest']
+
+    if session_end is not None and newest:
+        start_datetime = datetime.datetime.fromtimestamp(int(session_start))
+        end_datetime = datetime.datetime.fromtimestamp(int(session_end))
+        stats = cached('stats', (session_start, data_version), session_stats)
+        if stats:
             return [
                 html.H5('Last Session Duration: {}'.format(date.delta(start_datetime, end_datetime)[0]), className='card-text'),
                 html.Br(),
-                html.P('Session Average Bike Speed: {0:0.2f} MPH'.format(sum(speed_readings)/len(speed_readings)), className='card-text'),
-                html.P('Session Max Bike Speed: {0:0.2f} MPH'.format(max(speed_readings)), className='card-text'),
+                html.P('Session Average Bike Speed: {0:0.2f} MPH'.format(stats['speed_avg']), className='card-text'),
+                html.P('Session Max Bike Speed: {0:0.2f} MPH'.format(stats['speed_max']), className='card-text'),
                 html.Br(),
-                html.P('Session Average Resistance: {0:0.2f}'.format(sum(resistance_readings)/len(resistance_readings)), className='card-text'),
-                html.P('Session Max Resistance: {:d}'.format(max(resistance_readings)), className='card-text'),
+                html.P('Session Average Resistance: {0:0.2f}'.format(stats['resistance_avg']), className='card-text'),
+                html.P('Session Max Resistance: {:d}'.format(stats['resistance_max']), className='card-text'),
                 html.Br(),
-                html.P('Session Average Heart Rate: {0:0.2f} BPM'.format(sum(heart_readings)/len(heart_readings)), className='card-text'),
-                html.P('Session Max Heart Rate: {0:0.2f} BPM'.format(max(heart_readings)), className='card-text')
+                html.P('Session Average Heart Rate: {0:0.2f} BPM'.format(stats['heartrate_avg']), className='card-text'),
+                html.P('Session Max Heart Rate: {0:0.2f} BPM'.format(stats['heartrate_max']), className='card-text')
             ], 'Last session ended: {}'.format(date.duration(end_datetime))
-    elif r.exists('session_start') and r.exists('timestamp'):
-        start_datetime = datetime.datetime.fromtimestamp(int(r.get('session_start')))
+    elif session_start is not None and newest:
+        start_datetime = datetime.datetime.fromtimestamp(int(session_start))
+        latest_time, latest = sample_time(newest[0]), newest[1]
         return [
             html.H5('Current session started: {}'.format(date.duration(start_datetime)), className='card-title'),
-            html.P('Current Bike Speed: {0:0.2f} MPH'.format(float(r.lindex('bike_mph', 0))), className='card-text'),
-            html.P('Current Resistance: {:d}'.format(int(r.lindex('resistance', 0))), className='card-text'),
-            html.P('Current Heart Rate: {0:0.2f} BPM'.format(float(r.lindex('heart_bpm', 0))), className='card-text'),
-        ], 'Last Update: {}'.format(datetime.datetime.fromtimestamp(int(r.lindex('timestamp', 0))).strftime('%c'))
+            html.P('Current Bike Speed: {0:0.2f} MPH'.format(float(latest['bike_mph'])), className='card-text'),
+            html.P('Current Resistance: {:d}'.format(int(latest['resistance'])), className='card-text'),
+            html.P('Current Heart Rate: {0:0.2f} BPM'.format(float(latest['heart_bpm'])), className='card-text'),
+        ], 'Last Update: {}'.format(datetime.datetime.fromtimestamp(latest_time).strftime('%c'))
     return [html.P('Waiting to receive data from bike...', className='card-text', style={'fontStyle': 'italic'})], [""]
 
 
-# This callback fires on an interval to update the live graphs with the latest data from redis.
-@app.callback([Output('live-update-graph', 'figure'), Output('graph-spinner', 'style'), Output('live-graph-div', 'style')],
-              [Input('interval-component-slow', 'n_intervals')])
-def update_graph_live(n):
-    # Create the graph with subplots
-    fig = make_subplots(rows=3, cols=1, vertical_spacing=0.1, subplot_titles=("Bike Speed", "Resistance", "Heart Rate"))
-    fig.update_layout(
-        xaxis=dict(
-            fixedrange=True,
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Time",
-            zeroline=False,
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        xaxis2=dict(
-            fixedrange=True,
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Time",
-            zeroline=False,
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        xaxis3=dict(
-            fixedrange=True,
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Time",
-            zeroline=False,
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        yaxis=dict(
-            fixedrange=True,
-            range=[0, 35],
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Speed (mph)",
-            zeroline=False,
-            rangemode='nonnegative',
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        yaxis2=dict(
-            fixedrange=True,
-            range=[0, MAX_RESISTANCE],
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Resistance (" + str(MIN_RESISTANCE) + "-" + str(MAX_RESISTANCE) + ")",
-            zeroline=False,
-            rangemode='nonnegative',
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        yaxis3=dict(
-            fixedrange=True,
-            range=[0, 200],
-            title_font=dict(
-                size=16,
-                color='#839496',
-            ),
-            title_text="Heart Rate (bpm)",
-            zeroline=False,
-            rangemode='nonnegative',
-            showline=False,
-            showgrid=True,
-            showticklabels=True,
-            gridcolor='#839496',
-            ticks='outside',
-            tickfont=dict(
-                size=14,
-                color='#839496',
-            ),
-        ),
-        height=1100,
-        autosize=True,
-        margin=dict(
-            autoexpand=True,
-            l=30,
-            r=30,
-            b=30,
-            t=30,
-        ),
-        showlegend=False,
-        plot_bgcolor='rgba(0,0,0,0)',
-        paper_bgcolor='rgba(0,0,0,0)'
-    )
-
-    for i in fig['layout']['annotations']:
-        i['font'] = dict(size=20, color='#839496')
-
-    if r.exists('timestamp'):
+# This helper function downsamples a series with the Largest-Triangle-Three-Buckets algorithm, which keeps the visual shape
+# of the line (peaks, dips) far better than taking every Nth point.
+# Returns the indices of the points to plot, always including the first and last point.
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # Split everything between the first and last points into n_out - 2 buckets and pick one point from each
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    selected = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # The point kept from this bucket forms the largest triangle with the previously kept point and the average of the next bucket
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[selected] - avg_x) * (y[start:end] - y[selected]) - (x[selected] - x[start:end]) * (avg_y - y[selected]))
+        selected = start + int(np.argmax(areas))
+        indices[i + 1] = selected
+
+    return indices
+
+
+# This helper function round-trips a figure dict through orjson, which is several times faster than Plotly's own JSON encoder.
+# The NumPy arrays are serialized natively, including the datetime64 timestamps, which come out as ISO strings straight
+# from the array buffer without a Python datetime (and isoformat() call) per sample.
+# Returns the figure as plain dicts and lists.
+def figure_json(fig):
+    return orjson.loads(orjson.dumps(fig, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+# Every subplot axis shares the same styling, only the titles and y ranges differ
+TITLE_FONT = dict(size=16, color='#839496')
+TICK_FONT = dict(size=14, color='#839496')
+AXIS_STYLE = dict(
+    fixedrange=True,
+    title_font=TITLE_FONT,
+    zeroline=False,
+    showline=False,
+    showgrid=True,
+    showticklabels=True,
+    gridcolor='#839496',
+    ticks='outside',
+    tickfont=TICK_FONT,
+)
+X_AXIS = dict(AXIS_STYLE, title_text="Time")
+Y_AXIS = dict(AXIS_STYLE, rangemode='nonnegative')
+
+# The graph subplots and layout never change, so they are built once here. Plotly lays out the subplot axes and titles, and
+# each graph update then reuses the resulting layout dict as-is.
+base_figure = make_subplots(rows=3, cols=1, vertical_spacing=0.1, subplot_titles=("Bike Speed", "Resistance", "Heart Rate"))
+base_figure.update_layout(
+    xaxis=X_AXIS,
+    xaxis2=X_AXIS,
+    xaxis3=X_AXIS,
+    yaxis=dict(Y_AXIS, range=[0, 35], title_text="Speed (mph)"),
+    yaxis2=dict(Y_AXIS, range=[0, MAX_RESISTANCE], title_text="Resistance (" + str(MIN_RESISTANCE) + "-" + str(MAX_RESISTANCE) + ")"),
+    yaxis3=dict(Y_AXIS, range=[0, 200], title_text="Heart Rate (bpm)"),
+    height=1100,
+    autosize=True,
+    margin=dict(
+        autoexpand=True,
+        l=30,
+        r=30,
+        b=30,
+        t=30,
+    ),
+    showlegend=False,
+    plot_bgcolor='rgba(0,0,0,0)',
+    paper_bgcolor='rgba(0,0,0,0)'
+)
+
+for i in base_figure['layout']['annotations']:
+    i['font'] = dict(size=20, color='#839496')
+
+BASE_LAYOUT = base_figure.to_dict()['layout']
+
+# The layout embeds Plotly's full default template, which is sent to the browser with every graph update. Only keep the
+# parts of it that apply to these 2D scatter subplots, which leaves the graph unchanged while dropping ~6KB of defaults for
+# other trace types and polar/geo/3D axes from each update.
+BASE_LAYOUT['template'] = {
+    'data': {'scatter': BASE_LAYOUT['template']['data']['scatter']},
+    'layout': {k: v for k, v in BASE_LAYOUT['template']['layout'].items()
+               if k in ('colorway', 'font', 'hovermode', 'hoverlabel', 'paper_bgcolor', 'plot_bgcolor', 'xaxis', 'yaxis', 'title', 'annotationdefaults')}
+}
+
+
+# The style of each graph trace and the subplot axes it is drawn on. Only the x and y data change between updates, so
+# those are filled in per update. Plotly shows the y value on hover already, so the traces carry no separate text copy of it.
+SPEED_TRACE = {
+    'name': 'Bike Speed',
+    'mode': 'lines+markers',
+    'type': 'scatter',
+    'xaxis': 'x',
+    'yaxis': 'y',
+    'line': dict(color='#268BD2', width=2),
+    'marker': dict(color='#268BD2', size=6),
+}
+RESISTANCE_TRACE = {
+    'name': 'Resistance',
+    'mode': 'lines+markers',
+    'type': 'scatter',
+    'xaxis': 'x2',
+    'yaxis': 'y2',
+    'line': dict(color='#2aa198', width=2),
+    'marker': dict(color='#2aa198', size=6),
+}
+HEARTRATE_TRACE = {
+    'name': 'Heart Rate',
+    'mode': 'lines+markers',
+    'type': 'scatter',
+    'xaxis': 'x3',
+    'yaxis': 'y3',
+    'line': dict(color='#fd7e14', width=2),
+    'marker': dict(color='#fd7e14', size=6),
+}
+
+
+# This helper function converts sample times (in seconds, oldest first) to a datetime64 array, shifted to server local time so
+# they match what datetime.fromtimestamp() would give. Usually the whole range shares one UTC offset and is shifted in one step.
+# Only a range that crosses a daylight saving change is shifted sample by sample.
+def local_timestamps(seconds):
+    first_offset = time.localtime(int(seconds[0])).tm_gmtoff
+    if first_offset == time.localtime(int(seconds[-1])).tm_gmtoff:
+        offsets = first_offset
+    else:
+        offsets = np.array([time.localtime(int(t)).tm_gmtoff for t in seconds], dtype=np.int64)
+    return (seconds + offsets).astype('datetime64[s]')
+
+
+# This helper function builds the live graphs from every sample in the current session.
+# The key is only used by the memoization, so that each new data version is built once.
+# Returns a dict with the figure (as plain dicts and lists) and the stream ID of the newest sample it includes.
+@cache.memoize()
+def build_graph(key):
+    samples = session_samples()
+
+    # The figure is assembled as a plain dict, which skips Plotly's per-property validation of every trace
+    fig = {'data': [], 'layout': BASE_LAYOUT}
+    if samples['t']:
+        # Parse each column into a NumPy array in one pass, which Plotly accepts directly.
+        seconds = np.array(samples['t'], dtype=np.int64)
+        timestamps = local_timestamps(seconds)
+        speed = np.array(samples['bike_mph'], dtype=np.float64)
+        resistance = np.array(samples['resistance'], dtype=np.int64)
+        heartrate = np.array(samples['heart_bpm'], dtype=np.float64)
+
+        # Each trace keeps its own set of visually significant points
+        speed_idx = lttb_indices(seconds, speed, MAX_GRAPH_POINTS)
+        resistance_idx = lttb_indices(seconds, resistance, MAX_GRAPH_POINTS)
+        heartrate_idx = lttb_indices(seconds, heartrate, MAX_GRAPH_POINTS)
         data = {
-            'timestamp': [datetime.datetime.fromtimestamp(int(x)) for x in r.lrange('timestamp', 0, -1)],
-            'speed': [float(i) for i in r.lrange('bike_mph', 0, -1)],
-            'resistance': [int(i) for i in r.lrange('resistance', 0, -1)],
-            'heartrate': [float(i) for i in r.lrange('heart_bpm', 0, -1)]
+            'speed_timestamp': timestamps[speed_idx],
+            'speed': speed[speed_idx],
+            'resistance_timestamp': timestamps[resistance_idx],
+            'resistance': resistance[resistance_idx],
+            'heartrate_timestamp': timestamps[heartrate_idx],
+            'heartrate': heartrate[heartrate_idx]
         }
-        fig.append_trace({
-            'x': data['timestamp'],
-            'y': data['speed'],
-            'text': data['speed'],
-            'name': 'Bike Speed',
-            'mode': 'lines+markers',
-            'type': 'scatter',
-            'line': dict(color='#268BD2', width=2),
-            'marker': dict(color='#268BD2', size=6),
-        }, 1, 1)
-        fig.append_trace({
-            'x': data['timestamp'],
-            'y': data['resistance'],
-            'text': data['resistance'],
-            'name': 'Resistance',
-            'mode': 'lines+markers',
-            'type': 'scatter',
-            'line': dict(color='#2aa198', width=2),
-            'marker': dict(color='#2aa198', size=6),
-        }, 2, 1)
-        fig.append_trace({
-            'x': data['timestamp'],
-            'y': data['heartrate'],
-            'text': data['heartrate'],
-            'name': 'Heart Rate',
-            'mode': 'lines+markers',
-            'type': 'scatter',
-            'line': dict(color='#fd7e14', width=2),
-            'marker': dict(color='#fd7e14', size=6),
-        }, 3, 1)
-
-    return fig, {'display': 'none'}, {'visibility': 'visible'}
+        fig['data'] = [
+            dict(SPEED_TRACE, x=data['speed_timestamp'], y=data['speed']),
+            dict(RESISTANCE_TRACE, x=data['resistance_timestamp'], y=data['resistance']),
+            dict(HEARTRATE_TRACE, x=data['heartrate_timestamp'], y=data['heartrate'])
+        ]
+
+    # Serialize the figure once per data update. Every client is then handed plain dicts and lists that Dash can encode
+    # directly, rather than re-encoding the NumPy arrays (and all of the datetimes) on every tick.
+    return {'figure': figure_json(fig), 'last_id': samples['last_id']}
+
+
+# This callback fires on an interval to update the live graphs with the latest data from redis.
+# The whole (downsampled) figure is only sent when a client first loads or a new session starts. After that, each client's
+# graph-cursor store remembers the newest sample it has been sent, and only the samples since then are read from redis and
+# appended to its traces with extendData. Once MAX_GRAPH_POINTS samples have been appended this way, the full figure is sent
+# again so that long sessions stay downsampled in the browser too.
+@app.callback([Output('live-update-graph', 'figure'), Output('live-update-graph', 'extendData'), Output('graph-cursor', 'data'),
+               Output('graph-spinner', 'style'), Output('live-graph-div', 'style')],
+              [Input('interval-component-slow', 'n_intervals')],
+              [State('graph-cursor', 'data')])
+def update_graph_live(n, cursor):
+    state = session_state()
+    session_start, data_version = state['session_start'], state['data_version']
+
+    if cursor and cursor['session'] == session_start and cursor['last_id'] and cursor['extended'] < MAX_GRAPH_POINTS:
+        if cursor['version'] == data_version:
+            raise PreventUpdate
+
+        # XRANGE's start is inclusive, so the read starts from the stream ID just after the newest sample the client has
+        newest_ms, newest_seq = cursor['last_id'].split('-')
+        samples = session_samples(start='{}-{}'.format(newest_ms, int(newest_seq) + 1))
+        if samples['last_id'] is None:
+            raise PreventUpdate
+        timestamps = local_timestamps(np.array(samples['t'], dtype=np.int64))
+        extend_data = figure_json([
+            {'x': [timestamps, timestamps, timestamps],
+             'y': [np.array(samples['bike_mph'], dtype=np.float64),
+                   np.array(samples['resistance'], dtype=np.int64),
+                   np.array(samples['heart_bpm'], dtype=np.float64)]},
+            [0, 1, 2]
+        ])
+        cursor = dict(cursor, version=data_version, last_id=samples['last_id'], extended=cursor['extended'] + len(timestamps))
+        return dash.no_update, extend_data, cursor, dash.no_update, dash.no_update
+
+    graph = cached('graph', (session_start, data_version), build_graph)
+    cursor = {'session': session_start, 'version': data_version, 'last_id': graph['last_id'], 'extended': 0}
+    return graph['figure'], dash.no_update, cursor, {'display': 'none'}, {'visibility': 'visible'}
 
 
 if __name__ == '__main__':